@@ -1,6 +1,21 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import hashlib
 import io
+import math
+import re
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape as xml_escape
+
+# 啟用 copy-on-write，淺複製後改寫欄位不會影響原始 DataFrame
+pd.set_option("mode.copy_on_write", True)
+
+# 文字欄一律使用 Arrow 字串型別：資料存於連續 UTF-8 緩衝區，.str 操作走 Arrow 原生 kernel
+TEXT_DTYPE = "string[pyarrow]"
 
 # --- 頁面設定 ---
 st.set_page_config(page_title="布料索引自動比對系統", layout="wide")
@@ -19,87 +34,319 @@ st.sidebar.header("📂 檔案上傳區")
 uploaded_main = st.sidebar.file_uploader("1. 上傳主工作表 (需處理的檔案)", type=["xlsx", "xlsm"])
 uploaded_index = st.sidebar.file_uploader("2. 上傳 Fabric name index (索引檔)", type=["xlsx", "xlsm"])
 
-# --- 輔助函式：強力清洗鍵值 ---
-def clean_key_func(val):
-    if pd.isna(val) or val is None:
-        return ""
-    s = str(val).strip().upper()
-    if s.endswith(".0"):
-        s = s[:-2]
-    if s == "NAN":
-        return ""
-    return s
+# --- 輔助函式：強力清洗鍵值 (整欄向量化處理) ---
+def clean_key_series(col):
+    s = col.astype(TEXT_DTYPE).str.strip().str.upper()
+    s = s.str.removesuffix(".0")
+    s = s.fillna("")
+    return s.mask(s == "NAN", "")
+
+# --- 讀取上傳檔案 (依檔案內容快取，重新整理畫面時不必重新解析) ---
+# 快取為整個程序共用，限制筆數與存活時間，避免每次上傳的資料都常駐記憶體
+@st.cache_data(show_spinner=False, max_entries=8, ttl=3600)
+def load_excel(file_bytes, usecols=None, numeric_col=None):
+    # 讀取時一律用字串型別以利 A, D 欄比對
+    if numeric_col is None:
+        return pd.read_excel(io.BytesIO(file_bytes), header=0, dtype=TEXT_DTYPE, usecols=usecols, engine="calamine")
+
+    # numeric_col 指定的欄位 (主檔 H 欄) 保留儲存格原始型別，
+    # 數值不必先轉成字串、再於 process_data 中解析回數字
+    df = pd.read_excel(io.BytesIO(file_bytes), header=0, dtype=object, usecols=usecols, engine="calamine")
+    text_cols = [c for i, c in enumerate(df.columns) if i != numeric_col]
+    df[text_cols] = df[text_cols].astype(TEXT_DTYPE)
+    return df
 
 # --- 核心邏輯函數 ---
 def process_data(main_df, index_df):
-    # 1. 建立索引字典
-    index_keys = index_df.iloc[:, 0].apply(clean_key_func)
-    index_vals = index_df.iloc[:, 1]
-    index_dict = dict(zip(index_keys, index_vals))
+    # 1. 建立索引表 (重複鍵以最後一筆為準)
+    index_keys = clean_key_series(index_df.iloc[:, 0])
+    keep = ~index_keys.duplicated(keep="last")
+    index_tbl = pa.table({
+        "k": pa.array(index_keys[keep], type=pa.string()),
+        "v": pa.array(index_df.iloc[:, 1][keep], type=pa.string(), from_pandas=True),
+        "hit": pa.array(np.ones(int(keep.sum()), dtype=bool)),
+    })
     
-    # 2. 準備主檔數據
-    df_result = main_df.copy()
+    # 2. 準備主檔數據 (淺複製即可：搭配 copy-on-write，只有被改寫的欄位才會另存)
+    df_result = main_df.copy(deep=False)
     
     # --- 關鍵修正：將 H 欄 (Index 7) 轉回數字格式 ---
-    # errors='coerce' 會將無法轉換的文字變為 NaN，再用 fillna(0) 補齊
+    # 數值儲存格讀入時已是數字；errors='coerce' 會將無法轉換的文字變為 NaN，再用 fillna(0) 補齊
     if df_result.shape[1] >= 8:
-        df_result.iloc[:, 7] = pd.to_numeric(df_result.iloc[:, 7], errors='coerce').fillna(0)
+        col_h = df_result.iloc[:, 7]
+        # 布林儲存格過去以 "True"/"False" 字串讀入而轉為 0，先轉為 NaN 以維持相同結果
+        if pd.api.types.infer_dtype(col_h, skipna=True) not in ("floating", "integer", "mixed-integer-float", "empty"):
+            col_h = col_h.mask(col_h.map(lambda v: isinstance(v, bool)))
+        df_result[df_result.columns[7]] = pd.to_numeric(col_h, errors='coerce').fillna(0)
     
     # 3. 執行合併與比對邏輯 (A欄 + D欄)
-    main_keys = df_result.iloc[:, 0].apply(clean_key_func) + df_result.iloc[:, 3].apply(clean_key_func)
-    
-    new_e_column = []
-    highlight_mask = [] 
+    # 在 Arrow 中以原生 kernel 串接兩欄，結果直接作為 join 的鍵
+    main_keys = pc.binary_join_element_wise(
+        pa.array(clean_key_series(df_result.iloc[:, 0]), type=pa.string()),
+        pa.array(clean_key_series(df_result.iloc[:, 3]), type=pa.string()),
+        "",
+    )
     
-    for idx, key in enumerate(main_keys):
-        if key in index_dict:
-            new_e_column.append(index_dict[key])
-            highlight_mask.append(True)
-        else:
-            new_e_column.append(key)
-            highlight_mask.append(False)
+    # 以 Arrow hash join 一次完成查表；依 hit 判斷比對成功 (索引值本身為空時仍算成功)
+    main_tbl = pa.table({
+        "k": main_keys,
+        "ord": pa.array(np.arange(len(main_keys))),
+    })
+    joined = main_tbl.join(index_tbl, keys="k", join_type="left outer").sort_by("ord")
+    highlight_mask = pc.is_valid(joined["hit"]).to_numpy()
+    new_e_column = np.where(highlight_mask, joined["v"].to_numpy(), main_keys.to_numpy(zero_copy_only=False))
             
     # 寫入 E 欄 (Index 4)
-    while df_result.shape[1] < 5:
-        df_result[f'Col_{df_result.shape[1]}'] = None
-    df_result.iloc[:, 4] = new_e_column
+    # 欄數不足 5 欄時一次補齊，避免逐欄新增造成多次重建
+    n_cols = df_result.shape[1]
+    if n_cols < 5:
+        df_result = df_result.reindex(columns=list(df_result.columns) + [f'Col_{i}' for i in range(n_cols, 5)])
+    # E 欄多為少數索引值重複出現，以 category 儲存可共用同一批字串物件
+    df_result[df_result.columns[4]] = pd.Categorical(new_e_column)
         
     return df_result, highlight_mask
 
+# --- XLSX 檔案結構 (直接輸出 OOXML，不經 xlsxwriter) ---
+XML_DECL = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+NS_MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+NS_PKG_REL = "http://schemas.openxmlformats.org/package/2006/relationships"
+CT_PREFIX = "application/vnd.openxmlformats-officedocument.spreadsheetml"
+
+CONTENT_TYPES_XML = XML_DECL + (
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    f'<Override PartName="/xl/workbook.xml" ContentType="{CT_PREFIX}.sheet.main+xml"/>'
+    f'<Override PartName="/xl/worksheets/sheet1.xml" ContentType="{CT_PREFIX}.worksheet+xml"/>'
+    f'<Override PartName="/xl/styles.xml" ContentType="{CT_PREFIX}.styles+xml"/>'
+    f'<Override PartName="/xl/sharedStrings.xml" ContentType="{CT_PREFIX}.sharedStrings+xml"/>'
+    '</Types>'
+)
+
+ROOT_RELS_XML = XML_DECL + (
+    f'<Relationships xmlns="{NS_PKG_REL}">'
+    f'<Relationship Id="rId1" Type="{NS_REL}/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+
+WORKBOOK_XML = XML_DECL + (
+    f'<workbook xmlns="{NS_MAIN}" xmlns:r="{NS_REL}">'
+    '<sheets><sheet name="Result" sheetId="1" r:id="rId1"/></sheets>'
+    '</workbook>'
+)
+
+WORKBOOK_RELS_XML = XML_DECL + (
+    f'<Relationships xmlns="{NS_PKG_REL}">'
+    f'<Relationship Id="rId1" Type="{NS_REL}/worksheet" Target="worksheets/sheet1.xml"/>'
+    f'<Relationship Id="rId2" Type="{NS_REL}/styles" Target="styles.xml"/>'
+    f'<Relationship Id="rId3" Type="{NS_REL}/sharedStrings" Target="sharedStrings.xml"/>'
+    '</Relationships>'
+)
+
+# cellXfs 依序為：0 預設、1 標題 (沿用 pandas to_excel 樣式)、2 黃色底、3 H 欄數字格式
+STYLE_HEADER, STYLE_YELLOW, STYLE_NUMBER = 1, 2, 3
+THIN = '<color auto="1"/>'
+STYLES_XML = XML_DECL + (
+    f'<styleSheet xmlns="{NS_MAIN}">'
+    '<numFmts count="1"><numFmt numFmtId="164" formatCode="#,##0.00"/></numFmts>'
+    '<fonts count="2">'
+    '<font><sz val="11"/><name val="Calibri"/><family val="2"/></font>'
+    '<font><b/><sz val="11"/><name val="Calibri"/><family val="2"/></font>'
+    '</fonts>'
+    '<fills count="3">'
+    '<fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill>'
+    '<fill><patternFill patternType="solid"><fgColor rgb="FFFFFF00"/><bgColor indexed="64"/></patternFill></fill>'
+    '</fills>'
+    '<borders count="2">'
+    '<border><left/><right/><top/><bottom/><diagonal/></border>'
+    f'<border><left style="thin">{THIN}</left><right style="thin">{THIN}</right>'
+    f'<top style="thin">{THIN}</top><bottom style="thin">{THIN}</bottom><diagonal/></border>'
+    '</borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="4">'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="1" xfId="0" applyFont="1" applyBorder="1" applyAlignment="1">'
+    '<alignment horizontal="center" vertical="top"/></xf>'
+    '<xf numFmtId="0" fontId="0" fillId="2" borderId="0" xfId="0" applyFill="1"/>'
+    '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '</cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+# XML 1.0 不允許的控制字元，比照 Excel 以 _xHHHH_ 表示
+# 原本就是 _xHHHH_ 字樣的文字須先把底線編碼為 _x005F_，否則讀取時會被還原成字元
+ILLEGAL_XML_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+LITERAL_ESCAPES = re.compile(r"(_x[0-9a-fA-F]{4}_)")
+
+# Excel 單一儲存格字串上限，超過部分截斷 (與 xlsxwriter 相同)
+XLS_STRMAX = 32767
+
+def excel_col_name(col):
+    name = ""
+    col += 1
+    while col:
+        col, rem = divmod(col - 1, 26)
+        name = chr(65 + rem) + name
+    return name
+
+def xml_text(s):
+    s = LITERAL_ESCAPES.sub(r"_x005F\1", xml_escape(s))
+    s = ILLEGAL_XML_CHARS.sub(lambda m: f"_x{ord(m.group()):04X}_", s)
+    s = s.replace("\ufffe", "_xFFFE_").replace("\uffff", "_xFFFF_")
+    # 前後有空白時須加 xml:space="preserve"，否則 Excel 會去除
+    if s[:1].isspace() or s[-1:].isspace():
+        return f'<t xml:space="preserve">{s}</t>'
+    return f"<t>{s}</t>"
+
+# 儲存格型別：資料欄依 dtype 逐欄判斷一次，寫入時不必逐格做型別分派
+KIND_ANY, KIND_TEXT, KIND_NUMBER, KIND_BOOL = 0, 1, 2, 3
+
+def column_kind(col):
+    dtype = col.dtype
+    if isinstance(dtype, pd.StringDtype):
+        return KIND_TEXT
+    if isinstance(dtype, pd.CategoricalDtype):
+        return KIND_TEXT if pd.api.types.infer_dtype(dtype.categories) == "string" else KIND_ANY
+    if pd.api.types.is_bool_dtype(dtype):
+        return KIND_BOOL
+    if pd.api.types.is_numeric_dtype(dtype):
+        return KIND_NUMBER
+    return KIND_ANY
+
+def value_kind(v):
+    if isinstance(v, bool):
+        return KIND_BOOL
+    if isinstance(v, (int, float)):
+        return KIND_NUMBER
+    return KIND_TEXT
+
+def column_values(col):
+    # 每欄一次完成空值處理：NaN / NA 一律轉為 None，寫入時即為空白儲存格
+    return col.astype(object).where(col.notna(), None).tolist()
+
+def row_xml(r, row, styles, kinds, col_names, sst):
+    # 連續儲存格省略 r= 屬性；預設樣式 (0) 省略 s= 屬性；空值不輸出 (除非需套用黃色)
+    parts = [f'<row r="{r}">']
+    prev = -1
+    for c, v in enumerate(row):
+        s = styles[c]
+        kind = kinds[c]
+        if v is None or v == "":
+            cell = None
+        else:
+            if kind == KIND_ANY:
+                kind = value_kind(v)
+            if kind == KIND_TEXT:
+                if type(v) is not str:
+                    v = str(v)
+                if len(v) > XLS_STRMAX:
+                    v = v[:XLS_STRMAX]
+                idx = sst.get(v)
+                if idx is None:
+                    idx = sst[v] = len(sst)
+                cell = f' t="s"><v>{idx}</v></c>'
+            elif kind == KIND_NUMBER:
+                # 與 xlsxwriter 相同的數字格式 (%.16G)，整數值不帶 .0
+                cell = f'><v>{v:.16G}</v></c>' if math.isfinite(v) else None
+            else:
+                cell = f' t="b"><v>{int(v)}</v></c>'
+        if cell is None:
+            if s != STYLE_YELLOW:
+                continue
+            cell = '/>'
+        ref = "" if c == prev + 1 else f' r="{col_names[c]}{r}"'
+        style = f' s="{s}"' if s else ""
+        parts.append(f"<c{ref}{style}{cell}")
+        prev = c
+    parts.append("</row>")
+    return "".join(parts)
+
 # --- Excel 匯出函式 ---
 def convert_df_to_excel_with_highlight(df, mask):
+    n_rows, n_cols = df.shape
+    col_names = [excel_col_name(c) for c in range(n_cols)]
+
+    # 額外確保 H 欄在 Excel 中的格式 (Column index 7)；比對成功的 E 欄套用黃色
+    base_styles = [STYLE_NUMBER if c == 7 else 0 for c in range(n_cols)]
+    match_styles = list(base_styles)
+    match_styles[4] = STYLE_YELLOW
+
+    # 逐欄轉為 Python list 再以 zip 組成各列，不必建立整張表的 object 陣列
+    kinds = [column_kind(df.iloc[:, c]) for c in range(n_cols)]
+    rows = zip(*(column_values(df.iloc[:, c]) for c in range(n_cols)))
+    matches = np.asarray(mask, dtype=bool).tolist()
+
+    # 共用字串表：寫入工作表時依出現順序收集，最後再一次寫出
+    sst = {}
+
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Result')
-        
-        workbook = writer.book
-        worksheet = writer.sheets['Result']
-        
-        # 定義黃色格式
-        yellow_format = workbook.add_format({'bg_color': '#FFFF00'})
-        
-        # 遍歷 mask 上色 E 欄
-        for idx, is_match in enumerate(mask):
-            if is_match:
-                value_to_write = df.iloc[idx, 4]
-                if pd.isna(value_to_write):
-                    value_to_write = ""
-                worksheet.write(idx + 1, 4, value_to_write, yellow_format)
-                
-        # 額外確保 H 欄在 Excel 中的格式 (Column index 7)
-        # 如果需要特定的小數點位數，可以在此設定
-        num_format = workbook.add_format({'num_format': '#,##0.00'})
-        worksheet.set_column(7, 7, None, num_format)
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", CONTENT_TYPES_XML)
+        zf.writestr("_rels/.rels", ROOT_RELS_XML)
+        zf.writestr("xl/workbook.xml", WORKBOOK_XML)
+        zf.writestr("xl/_rels/workbook.xml.rels", WORKBOOK_RELS_XML)
+        zf.writestr("xl/styles.xml", STYLES_XML)
+
+        # 工作表逐列串流寫入壓縮檔，每 1000 列寫出一次
+        with zf.open("xl/worksheets/sheet1.xml", "w") as fh:
+            last_ref = f"{col_names[-1]}{n_rows + 1}"
+            fh.write((XML_DECL + (
+                f'<worksheet xmlns="{NS_MAIN}" xmlns:r="{NS_REL}">'
+                f'<dimension ref="A1:{last_ref}"/>'
+                '<cols><col min="8" max="8" width="9.140625" style="3"/></cols>'
+                '<sheetData>'
+            )).encode("utf-8"))
+
+            # 標題列直接由欄名組成，不經 DataFrame 轉換
+            buf = [row_xml(1, list(df.columns), [STYLE_HEADER] * n_cols, [KIND_ANY] * n_cols, col_names, sst)]
+            for r, (row, is_match) in enumerate(zip(rows, matches), start=2):
+                buf.append(row_xml(r, row, match_styles if is_match else base_styles, kinds, col_names, sst))
+                if len(buf) >= 1000:
+                    fh.write("".join(buf).encode("utf-8"))
+                    buf.clear()
+            buf.append("</sheetData></worksheet>")
+            fh.write("".join(buf).encode("utf-8"))
+
+        sst_xml = [XML_DECL, f'<sst xmlns="{NS_MAIN}" uniqueCount="{len(sst)}">']
+        sst_xml.extend(f"<si>{xml_text(s)}</si>" for s in sst)
+        sst_xml.append("</sst>")
+        zf.writestr("xl/sharedStrings.xml", "".join(sst_xml))
 
-    output.seek(0)
     return output.getvalue()
 
+# --- 預覽函式：只對前幾筆建立 Styler，避免整張表序列化到瀏覽器 ---
+PREVIEW_ROWS = 10
+
+def style_preview(df, mask):
+    preview = df.head(PREVIEW_ROWS)
+    preview_mask = np.asarray(mask[:len(preview)], dtype=bool)
+
+    def highlight_e(frame):
+        styles = pd.DataFrame("", index=frame.index, columns=frame.columns)
+        styles.iloc[:, 4] = np.where(preview_mask, "background-color: #FFFF00", "")
+        return styles
+
+    return preview.style.apply(highlight_e, axis=None)
+
+# --- 背景匯出用的執行緒 (每個 session 各一個，大檔匯出不會阻塞其他使用者) ---
+def get_export_executor():
+    if "export_executor" not in st.session_state:
+        st.session_state["export_executor"] = ThreadPoolExecutor(max_workers=1)
+    return st.session_state["export_executor"]
+
 # --- 主程式執行區 ---
 if uploaded_main and uploaded_index:
     try:
-        # 讀取時主檔仍用 str 以利 A, D 欄比對，但在 process_data 中會把 H 轉回數字
-        df_main = pd.read_excel(uploaded_main, header=0, dtype=str)
-        df_index = pd.read_excel(uploaded_index, header=0, dtype=str)
+        # 兩個檔案互不相依，同時解析；快取命中時會直接傳回
+        # 索引檔只用到 A, B 欄；主檔所有欄位都要輸出，故須完整讀取
+        main_bytes, index_bytes = uploaded_main.getvalue(), uploaded_index.getvalue()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            fut_main = executor.submit(load_excel, main_bytes, numeric_col=7)
+            fut_index = executor.submit(load_excel, index_bytes, usecols=[0, 1])
+            df_main, df_index = fut_main.result(), fut_index.result()
         
         st.success(f"✅ 檔案讀取成功！準備處理 {len(df_main)} 筆資料。")
         
@@ -107,14 +354,27 @@ if uploaded_main and uploaded_index:
             with st.spinner('正在處理中...'):
                 result_df, mask = process_data(df_main, df_index)
                 
-                st.info(f"📊 處理完成：{sum(mask)} 筆比對成功。H 欄已轉換為數字格式。")
+                st.info(f"📊 處理完成：{mask.sum()} 筆比對成功。H 欄已轉換為數字格式。")
+                
+                # 在背景產生 xlsx，同時先顯示預覽；同一組檔案重新執行時沿用既有結果
+                export_key = hashlib.sha1(main_bytes).hexdigest() + hashlib.sha1(index_bytes).hexdigest()
+                if st.session_state.get("export_key") != export_key:
+                    st.session_state["export_key"] = export_key
+                    st.session_state["export_future"] = get_export_executor().submit(
+                        convert_df_to_excel_with_highlight, result_df, mask
+                    )
                 
                 # 預覽
-                st.subheader("結果預覽 (前 10 筆)")
-                st.dataframe(result_df.head(10))
+                st.subheader(f"結果預覽 (前 {PREVIEW_ROWS} 筆)")
+                st.dataframe(style_preview(result_df, mask))
+                st.caption(f"共 {mask.sum()} 筆標記黃色，完整上色結果請下載 xlsx 檔查看。")
                 
                 # 下載
-                excel_data = convert_df_to_excel_with_highlight(result_df, mask)
+                export_future = st.session_state["export_future"]
+                if export_future.exception() is not None:
+                    # 匯出失敗時清除紀錄，下次點擊會重新產生而非重複拋出同一個錯誤
+                    del st.session_state["export_key"], st.session_state["export_future"]
+                excel_data = export_future.result()
                 
                 st.download_button(
                     label="📥 下載 merge.xlsx",
@@ -0,0 +1,60 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def build_frame():
+    return pd.DataFrame({
+        "A": ["_x0041_", "a\x01b", " lead", "a&b<c>", "x" * 40000],
+        "B": ["t ", None, "", "_X00ff_", "ok"],
+        "C": [1, 2, 3, 4, 5],
+        "D": ["d1", "d2", "d3", "d4", "d5"],
+        "E": pd.Categorical(["e1", None, "e3", None, "e5"]),
+        "F": ["f", "f", "f", "f", "f"],
+        "G": ["g", "g", "g", "g", "g"],
+        "H": [1.5, 0.0, 7.0, -2.25, 0.0],
+    })
+
+
+def write(df, mask):
+    return app.convert_df_to_excel_with_highlight(df, np.asarray(mask))
+
+
+def test_round_trip_values():
+    df = build_frame()
+    data = write(df, [True, True, False, True, False])
+    out = pd.read_excel(io.BytesIO(data), header=0, dtype=object, engine="calamine")
+
+    assert list(out.columns) == list(df.columns)
+    assert out["A"].tolist()[:4] == ["_x0041_", "a\x01b", " lead", "a&b<c>"]
+    assert len(out["A"].iloc[4]) == app.XLS_STRMAX
+    assert out["B"].iloc[0] == "t "
+    assert out["B"].iloc[3] == "_X00ff_"
+    assert pd.isna(out["B"].iloc[1]) and pd.isna(out["B"].iloc[2])
+    assert out["C"].tolist() == [1, 2, 3, 4, 5]
+    assert out["H"].tolist() == [1.5, 0, 7, -2.25, 0]
+
+
+def test_round_trip_formats():
+    openpyxl = pytest.importorskip("openpyxl")
+    df = build_frame()
+    data = write(df, [True, True, False, True, False])
+    ws = openpyxl.load_workbook(io.BytesIO(data)).active
+
+    assert ws.title == "Result"
+    assert all(ws.cell(row=1, column=c).font.b for c in range(1, 9))
+
+    yellow = [ws.cell(row=r, column=5).fill.fill_type == "solid" for r in range(2, 7)]
+    assert yellow == [True, True, False, True, False]
+    # 比對成功但值為空的 E 欄仍須保留黃色底
+    assert ws["E3"].value is None and ws["E5"].value is None
+
+    assert ws["H2"].number_format == "#,##0.00"